@@ -1,20 +1,56 @@
+import os
 import streamlit as st
 import joblib
 import numpy as np
 import pandas as pd
-import shap
-import matplotlib.pyplot as plt
-from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
+import onnxruntime as ort
+from catboost import Pool
+
+# Load the model once per process and keep only the best estimator
+@st.cache_resource
+def load_model(path):
+    model = joblib.load(path).best_estimator_
+    # Warm up SHAP on a dummy row so the first Predict click is not slowed by lazy initialization
+    dummy = np.zeros((1, len(model.feature_names_)), dtype=np.float32)
+    model.get_feature_importance(Pool(dummy, cat_features=model.get_cat_feature_indices()), type="ShapValues")
+    return model
+
+
+# Export the model to ONNX (again whenever the pickled model is newer) and open one inference session per process
+@st.cache_resource
+def load_onnx_session(_model, model_path, path):
+    if not os.path.exists(path) or os.path.getmtime(model_path) > os.path.getmtime(path):
+        _model.save_model(path, format="onnx", export_parameters={"onnx_domain": "ai.catboost"})
+    session = ort.InferenceSession(path, providers=["CPUExecutionProvider"])
+    # Warm up the session on a dummy row and check it agrees with the CatBoost model
+    dummy = np.zeros((1, len(_model.feature_names_)), dtype=np.float32)
+    onnx_prediction = session.run(None, {"features": dummy})[0].ravel()
+    if not np.allclose(onnx_prediction, _model.predict(dummy), rtol=1e-4, atol=1e-4):
+        raise RuntimeError(f"The ONNX model {path} does not match {model_path}; delete it to re-export")
+    return session
 
-# Load the model
-model_path = "cat_grid_search.pkl"
-model = joblib.load(model_path)
 
-# Get the best estimator
-best_model = model.best_estimator_
+# Read the SHAP JavaScript bundle once instead of on every force plot
+@st.cache_resource
+def get_shap_js():
+    import shap
+    return shap.getjs()
+
 
 # Set page configuration and title
 st.set_page_config(layout="wide", page_title="Concentration Prediction", page_icon="📊")
+
+# Load the model and get the best estimator
+model_path = "cat_grid_search.pkl"
+best_model = load_model(model_path)
+
+# ONNX Runtime serves the predictions; the CatBoost model is kept for SHAP
+onnx_path = "cat.onnx"
+onnx_session = load_onnx_session(best_model, model_path, onnx_path)
+
+# Column order the model was trained with
+FEATURE_ORDER = best_model.feature_names_
+
 st.title("📊 Concentration Prediction and SHAP Visualization")
 st.write("""
 By inputting feature values, you can obtain the model's prediction and understand the contribution of each feature using SHAP analysis. 
@@ -42,56 +78,92 @@ feature_ranges = {
     "V": {"type": "numerical", "min": 0.0, "max": 1000.0, "default": 10.0, "description": "Apparent volume of distribution of the drug (L)"}
 }
 
-# Dynamically generate the input interface
+# Dynamically generate the input interface inside a form so edits only rerun the script on submit
 inputs = {}
-for feature, config in feature_ranges.items():
-    if config["type"] == "numerical":
-        inputs[feature] = st.sidebar.number_input(
-            f"{feature} ({config['description']})",
-            min_value=config["min"],
-            max_value=config["max"],
-            value=config["default"]
-        )
-    elif config["type"] == "categorical":
-        inputs[feature] = st.sidebar.selectbox(
-            f"{feature} ({config['description']})",
-            options=config["options"],
-            index=config["options"].index(config["default"])
-        )
+with st.sidebar.form("inputs"):
+    for feature, config in feature_ranges.items():
+        if config["type"] == "numerical":
+            inputs[feature] = st.number_input(
+                f"{feature} ({config['description']})",
+                min_value=config["min"],
+                max_value=config["max"],
+                value=config["default"]
+            )
+        elif config["type"] == "categorical":
+            inputs[feature] = st.selectbox(
+                f"{feature} ({config['description']})",
+                options=config["options"],
+                index=config["options"].index(config["default"])
+            )
+
+    # Add a text box for the true value
+    true_value = st.number_input("True Value (mg/L)", min_value=0.0, max_value=100.0, value=0.0, step=0.1)
+
+    submitted = st.form_submit_button("Predict")
+
+# Features shown as integers in the SHAP plots and the scenario table; the model itself
+# stores SEX as a float feature, so the Pool takes its categorical indices from the model
+cat_features = ["SEX"]
 
-# Add a text box for the true value
-true_value = st.sidebar.number_input("True Value (mg/L)", min_value=0.0, max_value=100.0, value=0.0, step=0.1)
 
-# Convert the input features to a Pandas DataFrame
-features_df = pd.DataFrame([inputs])
+# Predict and explain a float32 array of rows in training column order with one call each
+def explain_rows(rows, model, session):
+    # CatBoost's native SHAP returns the expected value in the last column
+    sv = model.get_feature_importance(Pool(rows, cat_features=model.get_cat_feature_indices()), type="ShapValues")
+    predictions = session.run(None, {"features": rows})[0].ravel()
+    return predictions, sv[:, :-1], sv[0, -1]
 
-# If the model used categorical features during training, ensure these features are of integer type
-cat_features = ["SEX"]  # Assuming SEX is a categorical feature
-features_df[cat_features] = features_df[cat_features].astype(int)
 
-# Model prediction
+# Predict and explain a single input, memoized on the tuple of feature values
+# (the leading underscores stop Streamlit from hashing the model and session)
+@st.cache_data
+def predict_and_explain(inputs_tuple, _model, _session):
+    # Feed CatBoost a single float32 row in training column order instead of a one-row DataFrame
+    row = np.fromiter(inputs_tuple, dtype=np.float32, count=len(FEATURE_ORDER)).reshape(1, -1)
+    predictions, shap_values, expected_value = explain_rows(row, _model, _session)
+    return predictions[0], shap_values, expected_value
+
+
+# Predict and explain a table of scenarios in a single batch, memoized on the table contents
+@st.cache_data
+def predict_and_explain_batch(scenarios_df, _model, _session):
+    rows = scenarios_df[FEATURE_ORDER].to_numpy(dtype=np.float32)
+    return explain_rows(rows, _model, _session)
+
+
+# Model prediction, kept in session state so reruns that do not change the feature values
+# (e.g. submitting the scenario table) redisplay it without recomputing
 prediction = None  # Initialize prediction to None
-if st.button("Predict"):
+if submitted or "last_key" in st.session_state:
+    # shap and matplotlib are slow to import, so defer them until the first prediction
+    import shap
+    import matplotlib.pyplot as plt
+    import altair as alt
+
     try:
-        prediction = best_model.predict(features_df)[0]  # Prediction result is a continuous variable
+        inputs_tuple = tuple(inputs[f] for f in FEATURE_ORDER)
+        if st.session_state.get("last_key") != inputs_tuple:
+            st.session_state.prediction, st.session_state.shap_values, st.session_state.expected_value = predict_and_explain(
+                inputs_tuple, best_model, onnx_session
+            )
+            st.session_state.last_key = inputs_tuple
+        prediction = st.session_state.prediction  # Prediction result is a continuous variable
+        shap_values = st.session_state.shap_values
+        expected_value = st.session_state.expected_value
+
+        # Convert the input features to a Pandas DataFrame, only needed to label the SHAP plots
+        features_df = pd.DataFrame([inputs], columns=FEATURE_ORDER)
+        features_df[cat_features] = features_df[cat_features].astype(int)
 
         # Display the prediction result
         st.header("Prediction Result")
         st.success(f"Based on the feature values, the predicted concentration is {prediction:.2f} mg/L.")
 
-        # Save the prediction result as an image
-        fig, ax = plt.subplots(figsize=(8, 1))
-        text = f"Predicted Concentration: {prediction:.2f} mg/L"
-        ax.text(
-            0.5, 0.5, text,
-            fontsize=16,
-            ha='center', va='center',
-            fontname='Times New Roman',
-            transform=ax.transAxes
+        # Display the prediction result as styled text
+        st.markdown(
+            f"<h3 style='text-align:center;font-family:Times New Roman'>Predicted Concentration: {prediction:.2f} mg/L</h3>",
+            unsafe_allow_html=True
         )
-        ax.axis('off')
-        plt.savefig("prediction_text.png", bbox_inches='tight', dpi=300)
-        st.image("prediction_text.png", use_column_width=True)
 
         # Visualization display
         st.header("SHAP Visualization and Model Prediction Performance Analysis")
@@ -99,20 +171,16 @@ if st.button("Predict"):
         The following charts display the model's SHAP analysis results, including SHAP visualizations of feature contributions.
         """)
 
-        # Calculate SHAP values
         try:
-            explainer = shap.TreeExplainer(best_model)
-            shap_values = explainer.shap_values(features_df)
-
             # Generate SHAP force plot
             st.header("1. SHAP Force Plot")
             html_output = shap.force_plot(
-                explainer.expected_value,
+                expected_value,
                 shap_values[0, :],
                 features_df.iloc[0, :],
                 show=False
             )
-            shap_html = f"<head>{shap.getjs()}</head><body>{html_output.html()}</body>"
+            shap_html = f"<head>{get_shap_js()}</head><body>{html_output.html()}</body>"
             st.components.v1.html(shap_html, height=400)
 
             # Generate SHAP summary plot
@@ -121,25 +189,30 @@ if st.button("Predict"):
             shap.summary_plot(shap_values, features_df, plot_type="dot", show=False)
             plt.title("SHAP Values for Each Feature")
             st.pyplot(fig)
+            plt.close(fig)
 
             # Generate SHAP feature importance plot
             st.header("3. SHAP Feature Importance")
-            fig, ax = plt.subplots(figsize=(4, 3))
-            shap.summary_plot(shap_values, features_df, plot_type="bar", show=False)
-            plt.title("SHAP Values for Each Feature")
-            st.pyplot(fig)
+            importance = pd.DataFrame({"feature": features_df.columns, "importance": np.abs(shap_values).mean(0)})
+            importance_chart = alt.Chart(importance, title="SHAP Values for Each Feature").mark_bar().encode(
+                x=alt.X("importance:Q", title="mean(|SHAP value|)"),
+                y=alt.Y("feature:N", sort="-x", title=None)
+            )
+            st.altair_chart(importance_chart, use_container_width=True)
 
             # Generate SHAP decision plot
             st.header("4. SHAP Decision Plot")
             fig, ax = plt.subplots(figsize=(4, 3))
-            shap.decision_plot(explainer.expected_value, shap_values[0, :], features_df.iloc[0, :], show=False)
+            shap.decision_plot(expected_value, shap_values[0, :], features_df.iloc[0, :], show=False)
             plt.title("SHAP Decision Plot")
             st.pyplot(fig)
+            plt.close(fig)
 
         except Exception as e:
             st.error(f"An error occurred during SHAP visualization: {e}")
 
     except Exception as e:
+        st.session_state.pop("last_key", None)
         st.error(f"An error occurred during prediction: {e}")
 
 # Prediction accuracy plot
@@ -175,6 +248,69 @@ if true_value > 0 and prediction is not None:
 
     # Display the plot
     st.pyplot(fig)
+    plt.close(fig)
+
+# Scenario table: predict and explain several what-if inputs in one batch
+st.header("🧪 Scenario Comparison")
+st.write("Edit or add rows to compare several what-if scenarios; all rows are predicted and explained together.")
+
+# Restrict the scenario table to the same ranges and options as the sidebar inputs
+scenario_column_config = {}
+for feature, config in feature_ranges.items():
+    if config["type"] == "numerical":
+        scenario_column_config[feature] = st.column_config.NumberColumn(
+            feature,
+            help=config["description"],
+            min_value=config["min"],
+            max_value=config["max"]
+        )
+    elif config["type"] == "categorical":
+        scenario_column_config[feature] = st.column_config.SelectboxColumn(
+            feature,
+            help=config["description"],
+            options=config["options"]
+        )
+
+with st.form("scenarios"):
+    default_row = {feature: feature_ranges[feature]["default"] for feature in FEATURE_ORDER}
+    scenarios_df = st.data_editor(
+        pd.DataFrame([default_row] * 5),
+        column_config=scenario_column_config,
+        num_rows="dynamic",
+        use_container_width=True
+    )
+    scenarios_submitted = st.form_submit_button("Predict Scenarios")
+
+if scenarios_submitted:
+    # Only complete rows can be predicted
+    complete_df = scenarios_df.dropna().reset_index(drop=True)
+    skipped = len(scenarios_df) - len(complete_df)
+
+    if complete_df.empty:
+        st.warning(f"No complete scenario rows to predict ({skipped} incomplete rows skipped). Please fill in every column.")
+    else:
+        import shap
+        import matplotlib.pyplot as plt
+
+        if skipped:
+            st.warning(f"Skipped {skipped} incomplete scenario rows.")
+
+        try:
+            complete_df[cat_features] = complete_df[cat_features].astype(int)
+            predictions, scenario_shap_values, _ = predict_and_explain_batch(complete_df, best_model, onnx_session)
+
+            # Display the predictions next to the scenario inputs
+            st.dataframe(complete_df.assign(**{"Predicted Concentration (mg/L)": predictions}), use_container_width=True)
+
+            # Generate SHAP summary plot over all scenarios
+            fig, ax = plt.subplots(figsize=(4, 3))
+            shap.summary_plot(scenario_shap_values, complete_df[FEATURE_ORDER], plot_type="dot", show=False)
+            plt.title("SHAP Values Across Scenarios")
+            st.pyplot(fig)
+            plt.close(fig)
+
+        except Exception as e:
+            st.error(f"An error occurred during scenario prediction: {e}")
 
 # Footer
 st.markdown("---")
@@ -184,5 +320,6 @@ Through this page, you can:
 1. Perform real-time predictions using input feature values.
 2. Gain an intuitive understanding of the model's SHAP analysis results, including SHAP visualizations of feature contributions.
 3. If a true value is provided, the model's absolute and relative accuracy will also be displayed.
+4. Compare several what-if scenarios, predicted and explained together in one batch.
 These analyses help to deeply understand the model's prediction logic and the importance of features.
 """)